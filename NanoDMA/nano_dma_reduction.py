@@ -4,12 +4,10 @@ Created on Thu Apr 14 20:18:13 2016
 
 @author: jgairjr
 """
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from matplotlib import style
-from collections import defaultdict
-import sys, os, codecs, glob, statistics
+import numpy as np
+import sys, os, fnmatch, warnings
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 
 # If using Spyder instead of command line, set these variables appropriately
 USING_SPYDER = False # set to True if using Spyder
@@ -26,39 +24,11 @@ EXCLUDES = ['example.csv']
 # compatible with ASCII or UTF-8
 ENCODING = 'ISO-8859-1'
 
-
-class FreqData:
-    '''
-    Class representing the fields we care about from a single line of a data
-    file.
-    '''
-    def __init__(self,freq,stor,loss,comp,tand,damp):
-        '''
-        Constructor for a FreqData object 
-
-        @param freq     Frequency associated with this sample
-        @param stor     Storage value for this sample (GPa)
-        @param loss     Loss value for this sample (GPa)
-        @param comp     Complex value for this sample (GPa)
-        @param tand     Tan Delta value for this sample
-        @param damp     Damping value for this sample (kg/s)
-
-        @return     New FreqData object
-        '''
-        self.freq = freq
-        self.stor = stor
-        self.loss = loss
-        self.comp = comp
-        self.tand = tand
-        self.damp = damp
-
-    def __repr__(self):
-        '''
-        Defines text representation of this object.
-        '''
-        s = "FreqData({},{},{},{},{},{})".format(self.freq,self.stor,
-                self.loss,self.comp,self.tand,self.damp)
-        return s
+# These numbers represent indices that correspond to whitespace-separated
+# columns that we care about in the input files: frequency, storage, loss,
+# complex, tan delta, and damping. The parser only converts and stores these
+# columns; every other field on a line is tokenized and then dropped.
+COLUMNS = [7,14,15,17,18,22]
 
 
 def exitmsg(msg):
@@ -71,87 +41,86 @@ def exitmsg(msg):
     sys.exit(1)
 
 
-def process_input_file(filename,freqdata):
+def process_input_file(filename):
     '''
-    Processes the given input file. Adds fields from each data line,
-    organized by frequency, to the given frequency data dictionary.
+    Processes the given input file. Returns the fields we care about from
+    each data line as rows of an array, in the order frequency, storage,
+    loss, complex, tan delta, damping.
 
     @param filename     Name of the input file to be processed
-    @param freqdata     defaultdict where keys are frequencies and
-                        values are lists of FreqData objects
-    '''
-    data = list()
-    with codecs.open(filename,'r',ENCODING) as infile:
-        # iterate through every line of the file
-        for i,line in enumerate(infile):
-            # skip the first three lines
-            if i in [0,1,2]: continue
-            fields = line.split()
-            try:
-                freq = float(fields[7])
-                stor = float(fields[14])
-                loss = float(fields[15])
-                comp = float(fields[17])
-                tand = float(fields[18])
-                damp = float(fields[22])
-                # at each frequency, I append the values associated
-                # with that frequency to the list of FreqData objects
-                freqdata[freq].append(FreqData(freq,stor,loss,comp,tand,damp))
-            except ValueError as e:
-                exitmsg('error in {} at line {}: {}'.format(filename,i+1,e))
-
-
-def compute_stats(data):
-    '''
-    Computes mean and standard deviation of input data list.
-
-    @param data     List of input data samples
 
-    @return mean(data), stdev(data)
-    '''
-    return statistics.mean(data), statistics.stdev(data)
-
-
-def write_summary_header(outfile,sep='\t'):
-    '''
-    Writes header line to the output summary file.
-
-    @param outfile  Open file handle corresponding to output file
-    @param sep      Separator to use for output file. Defaults to tab,
-                    but could also be comma
-    '''
-    header  = "Frequency (Hz){}".format(sep)
-    header += "Mean Storage (GPa){}Sigma Storage (GPa){}".format(sep,sep)
-    header += "Mean Loss (GPa){}Sigma Loss (GPa){}".format(sep,sep)
-    header += "Mean Complex (GPa){}Sigma Complex (GPa){}".format(sep,sep)
-    header += "Mean Tan Delta{}Sigma Tan Delta{}".format(sep,sep)
-    header += "Mean Damping (kg/s){}Sigma Damping (kg/s){}".format(sep,sep)
-    outfile.write(header + '\n')
-
-
-def write_summary_file(filename,stats,sep='\t'):
-    '''
-    Writes the given stats, assumed to be collated by frequency, to
-    the given output file. Assumes that the order of fields corresponding
-    to each frequency is in the same order as the header line above.
+    @return     (N,6) array of data from the input file
+    '''
+    # skip the first three lines. numpy's parser is written in C and
+    # reports the line number of any bad field. A file with nothing after
+    # the header lines just gives an empty array, which main() accounts
+    # for, so numpy's warning about it is not needed.
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',UserWarning)
+            return np.loadtxt(filename,skiprows=3,usecols=COLUMNS,
+                              encoding=ENCODING,dtype=np.float64,ndmin=2)
+    except ValueError as e:
+        exitmsg('error in {}: {}'.format(filename,e))
+
+
+def compute_stats(data,starts):
+    '''
+    Computes the mean and (sample) standard deviation of each group of
+    samples in each row of the input data. Each group is a contiguous run
+    of samples, and every row is grouped the same way.
+
+    @param data     2D array where each row is a field and each column
+                    is a sample
+    @param starts   Index of the first sample in each group
+
+    @return means, sdevs    Arrays with one row per field and one
+                            column per group
+    '''
+    counts = np.diff(np.append(starts,data.shape[1]))
+    means = np.add.reduceat(data,starts,axis=1) / counts
+    # subtract the mean of each group from its samples before squaring,
+    # which is much more accurate than using the sum of squares directly
+    dev = data - np.repeat(means,counts,axis=1)
+    # the deviations would sum to zero if the means were exact, so their
+    # actual sum measures the rounding error in the means and can be used
+    # to correct the sum of squares (the "corrected two-pass" algorithm)
+    err = np.add.reduceat(dev,starts,axis=1)
+    ssq = np.add.reduceat(dev*dev,starts,axis=1) - err*err/counts
+    # a group with a single sample has no standard deviation
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sdevs = np.sqrt(ssq / (counts-1))
+    return means, sdevs
+
+
+def write_summary_file(filename,freqs,means,sdevs,sep='\t'):
+    '''
+    Writes the given stats, collated by frequency, to the given output
+    file. Assumes that the order of fields corresponding to each frequency
+    is in the same order as the header line below.
     
     @param filename     Name of the output file to be created
-    @param stats        Dictionary of statistics, where keys are frequencies
-                        and values are tuples of statistics corresponding to
-                        the fields we acare about
+    @param freqs        Sorted array of frequencies
+    @param means        Array of mean values with one row per field and
+                        one column per frequency
+    @param sdevs        Array of standard deviations with the same shape
+                        as means
     @param sep      Separator to use for output file. Defaults to tab,
                     but could also be comma
     '''
-    with open(filename,'w') as f:
-        write_summary_header(f,sep)
-        frequencies = sorted(stats.keys())
-        for freq in frequencies:
-            outline = "{}\t".format(freq)
-            for mean,sdev in stats[freq]:
-                outline += "{}\t{}\t".format(mean,sdev)
-            # replace the last tab with a newline
-            outline = outline[:-1] + '\n'
-            f.write(outline)
+    header = sep.join(["Frequency (Hz)",
+                       "Mean Storage (GPa)","Sigma Storage (GPa)",
+                       "Mean Loss (GPa)","Sigma Loss (GPa)",
+                       "Mean Complex (GPa)","Sigma Complex (GPa)",
+                       "Mean Tan Delta","Sigma Tan Delta",
+                       "Mean Damping (kg/s)","Sigma Damping (kg/s)"])
+    # each output line is the frequency followed by (mean,sdev) pairs
+    out = np.empty((len(freqs),1+2*len(means)))
+    out[:,0] = freqs
+    out[:,1::2] = means.T
+    out[:,2::2] = sdevs.T
+    # '%s' writes each value with the shortest repr that round-trips
+    np.savetxt(filename,out,fmt='%s',delimiter=sep,header=header,comments='')
 
 
 def process_arguments():
@@ -199,51 +168,71 @@ def main():
     '''
     source_dir, outfile, verbose = process_arguments()
     # also want to exclude our output file
-    excludes = EXCLUDES + [os.path.basename(outfile)]
-
-    # frequencies is a dictionary where each key is
-    # a single frequency and each value is a list
-    frequencies = defaultdict(list)
-    infiles = glob.glob("{}/*.csv".format(source_dir))
-    if len(infiles) == 0:
+    excludes = frozenset(EXCLUDES + [os.path.basename(outfile)])
+
+    # find all of the CSV files in the source directory. Like a shell glob,
+    # this ignores hidden files and is case-insensitive on Windows.
+    with os.scandir(source_dir) as entries:
+        candidates = [e for e in entries if fnmatch.fnmatch(e.name,'*.csv')
+                      and not e.name.startswith('.') and e.is_file()]
+    if len(candidates) == 0:
         exitmsg("No input files found in given input directory {}".format(source_dir))
-    for filename in infiles:
-        # skip files that should not be processed
-        if os.path.basename(filename) in excludes: continue
-        if verbose: print("processing {}".format(filename))
-        process_input_file(filename,frequencies)
-    if len(frequencies) == 0:
+    # skip files that should not be processed
+    infiles = [e.path for e in candidates if e.name not in excludes]
+    if len(infiles) == 0:
         exitmsg("No input files were processed")
-
-    stats = dict()
-    # now analyze data at each frequency
-    for freq in frequencies:
-        # this is the list of all the stats at this frequency
-        data = frequencies[freq]
-        # sorry, this is not that efficient :(
-        stor_stats = compute_stats([x.stor for x in data])
-        loss_stats = compute_stats([x.loss for x in data])
-        comp_stats = compute_stats([x.comp for x in data])
-        tand_stats = compute_stats([x.tand for x in data])
-        damp_stats = compute_stats([x.damp for x in data])
-        # collect all of the statistics at this frequency
-        # each statistic is a pair representing (mean,sdev)
-        # NOTE: the order of these fields should be the same as the order
-        # in the header so that the fields are aligned properly
-        stats[freq] = (stor_stats, loss_stats, comp_stats, tand_stats, damp_stats)
+    if verbose:
+        for filename in infiles:
+            print("processing {}".format(filename))
+    # each file is independent, so parse them in parallel when there is
+    # more than one. Worker processes can't import functions defined in an
+    # interactive Spyder session, so everything is parsed right here in that
+    # case. Either way, results come back in the same order as the files.
+    if len(infiles) == 1 or USING_SPYDER:
+        results = list(map(process_input_file,infiles))
+    else:
+        chunksize = max(1,len(infiles) // (4*(os.cpu_count() or 1)))
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(process_input_file,infiles,
+                                        chunksize=chunksize))
+    num_samples = sum(len(r) for r in results)
+    if num_samples == 0:
+        exitmsg("No input files were processed")
+    # store each field as its own contiguous column, in the order freq,
+    # stor, loss, comp, tand, damp. Each file's samples are copied straight
+    # into place instead of being stacked first and then transposed.
+    columns = np.empty((len(COLUMNS),num_samples))
+    start = 0
+    for r in results:
+        columns[:,start:start+len(r)] = r.T
+        start += len(r)
+    # sort the samples by frequency. All of the samples at a given
+    # frequency are then a single slice of each column.
+    order = np.argsort(columns[0],kind='stable')
+    columns = np.take(columns,order,axis=1)
+    # the frequencies are already sorted, so each group starts wherever
+    # the frequency changes (np.unique would sort them all over again)
+    freq = columns[0]
+    starts = np.flatnonzero(np.append(True,freq[1:] != freq[:-1]))
+    freqs = freq[starts]
+    # NOTE: the order of the fields in these is the same as the order
+    # in the summary file header so that the fields are aligned properly
+    means, sdevs = compute_stats(columns[1:],starts)
 
     if verbose: print("writing summary file: {}".format(outfile))
-    write_summary_file(outfile,stats)
+    write_summary_file(outfile,freqs,means,sdevs)
 
     # This program doesn't do any graphing yet.
-    # The summarized statistics, organized by frequency, are in the
-    # data structure named 'stats'. Here's how you might go about
-    # graphing something like mean loss against frequency:
+    # The summarized statistics are in the arrays named 'means' and
+    # 'sdevs', where each column corresponds to the frequency at the same
+    # index in 'freqs'. Here's how you might go about graphing something
+    # like mean loss against frequency:
     #
-    #   # collect all the frequencies and sort them
-    #   x_data = sorted(stats.keys())
+    #   import matplotlib.pyplot as plt
+    #   # the frequencies are already sorted
+    #   x_data = freqs
     #   # collects all of the mean loss values corresponding to each frequency
-    #   y_data = [stats[freq][1][0] for freq in x_data]
+    #   y_data = means[1]
     #   # do graphing here
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
-from sqlalchemy import create_engine
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, Date
+from sqlalchemy import create_engine, inspect
+from sqlalchemy import Column, Integer, String, Date, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-import logging, os
+from sqlalchemy.orm import sessionmaker
+import numpy as np
+import sys, logging, os, warnings
 
 Base = declarative_base()
 Session = sessionmaker()
 
+# number of CSV lines handed to the parser at once when adding a data set
+BLOCK_LINES = 4096
+
 
 class DataSet(Base):
     __tablename__ = 'dataset'
@@ -15,14 +19,24 @@ class DataSet(Base):
     name = Column(String, nullable=False)
     date = Column(Date)
 
-    datapoints = relationship("DataPoint", back_populates="dataset")
+    # all of the data points are stored together as a single array of
+    # float64 (time,temperature,heat_flow) triples
+    samples = Column(LargeBinary)
 
     def __init__(self,name,date=None):
         self.name = name
         self.date = date
 
-    def add_datapoint(self,time,temperature,heat_flow):
-        self.datapoints.append(DataPoint(time,temperature,heat_flow))
+
+    def datapoints(self):
+        '''
+        Returns the data points in this data set.
+
+        @return Array with one (time,temperature,heat_flow) row per point
+        '''
+        if self.samples is None:
+            return np.empty((0,3))
+        return np.frombuffer(self.samples,dtype=np.float64).reshape(-1,3)
 
 
     def num_datapoints(self):
@@ -31,7 +45,10 @@ class DataSet(Base):
 
         @return Number of data points in this data set.
         '''
-        return len(dataset)
+        if self.samples is None:
+            return 0
+        # each data point is three 8-byte floats
+        return len(self.samples) // (3*8)
 
 
     def __repr__(self):
@@ -39,28 +56,24 @@ class DataSet(Base):
         return s
 
 
-class DataPoint(Base):
-    __tablename__ = 'datapoint'
+def is_data_line(line):
+    '''
+    Determines whether the given line of a data set CSV holds a data point.
 
-    id = Column(Integer, primary_key=True)
-    dataset_id = Column(Integer, ForeignKey('dataset.id'))
-    # what is the precision of this?
-    time = Column(Float, nullable=False)
-    temperature = Column(Float, nullable=False)
-    heat_flow = Column(Float, nullable=False)
+    @param line Line of text to be checked
 
-    dataset = relationship("DataSet", back_populates="datapoints")
-
-    def __init__(self,time,temperature,heat_flow):
-        self.time = time
-        self.temperature = temperature
-        self.heat_flow = heat_flow
-
-
-    def __repr__(self):
-        s = "<DataPoint(time={},temperature={},heat_flow={})>" \
-                .format(self.time,self.temperature,self.heat_flow)
-        return s
+    @return True if all three fields are numbers
+    '''
+    # a line with the wrong number of fields is not just a bad line
+    time, temp, heat = line.split(',')
+    try:
+        # float() ignores surrounding whitespace, including the trailing
+        # newline on the last field
+        float(time), float(temp), float(heat)
+    # assume that a parsing error means we got a bad line
+    except ValueError:
+        return False
+    return True
 
 
 class Database():
@@ -87,6 +100,18 @@ class Database():
         '''
         logging.info("opening database connection")
         self.engine = create_engine('sqlite:///'+filename)
+        # databases created before data points were stored as a single blob
+        # per data set have a separate datapoint table and no samples column.
+        # Inspecting connects to the database, which would create the file,
+        # so only do it if the file is already there.
+        if os.path.exists(filename):
+            inspector = inspect(self.engine)
+            tables = inspector.get_table_names()
+            if 'datapoint' in tables or ('dataset' in tables and 'samples'
+                    not in [c['name'] for c in inspector.get_columns('dataset')]):
+                logging.critical("database {} uses an old schema and must be "
+                                 "recreated".format(filename))
+                sys.exit(1)
         Session.configure(bind=self.engine)
         self.session = Session()
         self.datasets = list()
@@ -105,12 +130,35 @@ class Database():
         ds = DataSet(ds_name)
         logging.debug("parsing CSV file")
         with open(filename,'r') as f:
-            for line in f:
-                if line == '\n': continue
-                time, temp, heat = line.split(',')
-                if time == "" or temp == "" or heat == "":
-                    continue
-                ds.add_datapoint(time,temp,heat)
+            lines = f.readlines()
+        # parse the lines in C a block at a time. Only a block that has a
+        # bad line in it (e.g. a column header or a missing value) is
+        # checked line by line, so that the bad lines can be dropped.
+        # Blank lines are skipped by the parser; a block with nothing else
+        # in it gives an empty array, and numpy's warning about that is
+        # not needed.
+        blocks = list()
+        skipped = 0
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',UserWarning)
+            for i in range(0,len(lines),BLOCK_LINES):
+                block = lines[i:i+BLOCK_LINES]
+                try:
+                    values = np.loadtxt(block,delimiter=',',ndmin=2)
+                except ValueError:
+                    block = [l for l in block if l.strip()]
+                    good = [l for l in block if is_data_line(l)]
+                    skipped += len(block) - len(good)
+                    values = np.loadtxt(good,delimiter=',',ndmin=2)
+                if values.size == 0: continue
+                if values.shape[1] != 3:
+                    raise ValueError("expected 3 fields per line in {}, got {}"
+                                     .format(filename,values.shape[1]))
+                blocks.append(values)
+        if skipped > 0:
+            logging.warning("skipped {} unparseable lines".format(skipped))
+        values = np.concatenate(blocks) if blocks else np.empty((0,3))
+        ds.samples = values.tobytes()
         num_points = ds.num_datapoints()
         if num_points == 0:
             logging.error("empty dataset")
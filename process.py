@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import sys, os, codecs, math
+import sys, os
 from argparse import ArgumentParser
-from scipy import stats
-import matplotlib.pyplot as plt
-from matplotlib import style
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import matplotlib
 
 # Reading the summary file fails unless this encoding is used. The encoding
 # seems to correspond to a codepage from Windows called Latin 1, but it is not
@@ -11,6 +12,12 @@ from matplotlib import style
 ENCODING = 'ISO-8859-1'
 DEFAULT_Z_THRESH = 3    # standard deviations
 
+# these numbers represent indices that correspond to whitespace-separated
+# columns that we care about in the summary file: depth, stiffness, hardness
+SUMMARY_COLUMNS = (7,9,10)
+# same thing for the data point files: depth, load, time
+DATAPOINT_COLUMNS = (0,1,2)
+
 
 class DataLine():
     '''
@@ -25,7 +32,8 @@ class DataLine():
         @param depth    Max depth for this data point (nm)
         @param stiff    Overall stiffness for this data point (GPa)
         @param hard     Overall hardness for this data point (GPa)
-        @param line     Verbatim line from summary file representing this point
+        @param line     Verbatim line (bytes) from summary file representing
+                        this point
 
         @return     New DataLine object
         '''
@@ -45,31 +53,6 @@ class DataLine():
         return s
 
 
-class DataSample():
-    '''
-    Class representing a single sample from a data point file.
-    '''
-    def __init__(self,time,depth,load):
-        '''
-        Constructor for a DataSample object
-
-        @param time     Time (in seconds)
-        @param depth    Depth (in nanometers)
-        @param load     Load (in micro Newtons)
-        '''
-        self.time = time
-        self.depth = depth
-        self.load = load
-
-
-    def __repr__(self):
-        '''
-        Defines the text representation of this object.
-        '''
-        s = "DataSample({},{},{})".format(self.time,self.depth,self.load)
-        return s
-
-
 def exitmsg(msg):
     '''
     Prints the given message to <stderr> and exits
@@ -80,133 +63,149 @@ def exitmsg(msg):
     sys.exit(1)
 
 
+def is_data_line(filename,line,columns):
+    '''
+    Determines whether the given line from the given file has a number
+    in each of the given columns.
+
+    @param filename     Path to the file the line was read from
+    @param line         Line of text to be checked
+    @param columns      Indices of the whitespace-separated fields that
+                        should be numbers
+
+    @return     True if all of the given fields are numbers
+    '''
+    fields = line.split()
+    try:
+        for c in columns:
+            float(fields[c])
+    # assume that a parsing error means we got a bad line
+    except ValueError:
+        return False
+    # any other error means something went horribly wrong
+    except Exception as e:
+        s = "problem encountered parsing '{}': {}".format(filename,str(e))
+        exitmsg(s)
+    return True
+
+
 def read_summary_file(filename):
     '''
-    Reads and parses given summary file into a list of DataLines.
-    Returns the header line and the list of DataLine objects
+    Reads and parses given summary file. Returns the header line along with
+    arrays of the fields we care about, where each index in the arrays
+    corresponds to a single data point.
 
     @param filename     Path to the summary file to be parsed
 
-    @return     (header,DataLines)
+    @return     (header,fnames,lines,fields) where fnames are the names of
+                the data point files, lines are the verbatim lines from the
+                summary file, and fields is an array whose rows are the max
+                depth (nm), overall stiffness (GPa) and overall hardness
+                (GPa) of each point
     '''
-    data = list()
     # check if the file exists
     if not os.path.exists(filename):
         exitmsg("given file '{}' does not exist".format(filename))
-    # we can't just use the default encoding of ASCII/UTF-8
-    with codecs.open(filename,'r',ENCODING) as f:
-        for i,line in enumerate(f):
-            # skip the first line and third line
-            if i == 0: continue
-            # capture the header line
-            if i == 2:
-                header = line.strip()
-                continue
-            # skip the empty lines
-            if line == '' or line == '\n': continue
-            # CURSE THEE WINDOWS!!!! (line feed and carriage return)
-            if line == "\x0d\x0a" or line == "\x0d": continue
-            # split each data line into individual fields
-            fields = line.split()
-            if len(fields) == 0: continue
-            # build the name of the data file
-            try:
-                filename = "{} {} LC.txt".format(fields[0],fields[1])
-                # these numbers represent indices that correspond to
-                # whitespace-separated columns that we care about
-                # in the summary file
-                depth = float(fields[7])
-                stiffness = float(fields[9])
-                hardness = float(fields[10])
-            # assume that a parsing error means we got a bad line
-            except ValueError:
-                continue
-            # any other error means something went horribly wrong
-            except Exception as e:
-                s = "problem encountered parsing '{}': {}".format(filename,str(e))
-                exitmsg(s)
-            data.append(DataLine(filename,depth,stiffness,hardness,line.strip()))
-    return (header,data)
-
-
-def write_summary_file(path,points,header):
+    # the data lines are plain ASCII, so the file is read as raw bytes and
+    # only the header line is decoded. We can't just use the default
+    # encoding of ASCII/UTF-8 for that.
+    with open(filename,'rb') as f:
+        contents = f.read().splitlines()
+    # skip the first line and capture the header line
+    header = contents[2].decode(ENCODING).strip()
+    # skip the empty lines (stripping takes care of the CURSED
+    # Windows line feeds and carriage returns as well)
+    lines = [line for line in (l.strip() for l in contents[3:]) if line]
+    # parse all of the numbers we care about in one go
+    try:
+        values = np.loadtxt(lines,usecols=SUMMARY_COLUMNS,comments=None,
+                            ndmin=2)
+    # if there are any bad lines, drop them and try again
+    except ValueError:
+        lines = [l for l in lines if is_data_line(filename,l,SUMMARY_COLUMNS)]
+        values = np.loadtxt(lines,usecols=SUMMARY_COLUMNS,comments=None,
+                            ndmin=2)
+    # build the names of the data files from the first two columns
+    names = np.loadtxt(lines,dtype=str,usecols=(0,1),comments=None,ndmin=2,
+                       encoding=ENCODING)
+    fnames = np.char.add(np.char.add(names[:,0],' '),
+                         np.char.add(names[:,1],' LC.txt'))
+    # store each field as its own contiguous row
+    fields = np.ascontiguousarray(values.T)
+    return (header,fnames,np.array(lines,dtype=object),fields)
+
+
+def write_summary_file(path,lines,header):
     '''
     Creates a summary file at the given path and writes out
-    the given set of DataPoint objects.
+    the given set of summary file lines.
 
     @param  path    Path of the summary file to be created and written
-    @param  points  List of DataPoint objects to be written to file
+    @param  lines   Verbatim summary file lines (bytes), one per data point
     @param  header  Line of text representing summary file header  
     '''
-    # for the sake of consistency write the file with the same encoding
-    with codecs.open(path,'w',ENCODING) as f:
+    # for the sake of consistency write the file with the same encoding.
+    # The lines are written back out exactly as they were read.
+    with open(path,'wb') as f:
         # duplicate the first line
-        f.write("Number of Data Points = {}\n\n".format(len(points)))
+        f.write("Number of Data Points = {}\n\n".format(len(lines))
+                .encode(ENCODING))
         # duplicate the header line
-        f.write(header + '\n')
-        for p in points:
-            f.write(p.line + '\n')
+        f.write((header + '\n').encode(ENCODING))
+        for line in lines:
+            f.write(line + b'\n')
 
 
 def read_datapoint_file(filename):
     '''
     Reads and parses data point file with the given filename.
-    Returns a list of DataSample objects representing the samples
-    in this file.
+    Returns arrays representing the samples in this file.
 
     @param filename     Path to the data point file to be parsed 
 
-    @return     List of DataSample objects
+    @return     (depth,load,time) arrays with one entry per sample, in
+                nanometers, micro Newtons, and seconds respectively
     '''
-    samples = list()
     # check if the file exists
     if not os.path.exists(filename):
         exitmsg("given file '{}' does not exist".format(filename))
-    # we can't just use the default encoding of ASCII/UTF-8
-    with codecs.open(filename,'r',ENCODING) as f:
-        for i,line in enumerate(f):
-            # skip the first four lines
-            if i < 4: continue
-            # skip the empty lines
-            if line == "" or line == '\n': continue
-            # CURSE THEE WINDOWS!!!! (line feed and carriage return)
-            if line == "\x0d\x0a" or line == "\x0d": continue
-            fields = line.split()
-            try:
-                depth = float(fields[0])
-                load = float(fields[1])
-                time = float(fields[2])
-            # assume that a parsing error means we have a bad line
-            except ValueError:
-                continue
-            # any other error means something went horribly wrong
-            except Exception as e:
-                s = "problem encountered parsing '{}': {}".format(filename,str(e))
-                exitmsg(s)
-            ds = DataSample(time,depth,load)
-            samples.append(ds)
-    return samples
+    # skip the first four lines. Blank lines (Windows or otherwise) are
+    # skipped by the parser.
+    try:
+        values = np.loadtxt(filename,skiprows=4,usecols=DATAPOINT_COLUMNS,
+                            encoding=ENCODING,comments=None,ndmin=2)
+    # if there are any bad lines, drop them and try again
+    except ValueError:
+        # the data lines are plain ASCII, so there's no need to decode them
+        with open(filename,'rb') as f:
+            lines = f.read().splitlines()[4:]
+        lines = [l for l in lines if l.strip() and
+                 is_data_line(filename,l,DATAPOINT_COLUMNS)]
+        values = np.loadtxt(lines,usecols=DATAPOINT_COLUMNS,comments=None,
+                            ndmin=2)
+    # store each field as its own contiguous array
+    depth, load, time = np.ascontiguousarray(values.T)
+    return depth, load, time
 
 
 def calculate_stats(samples,samplevar=True):
     '''
-    Calculates the mean and standard deviation of a given list of samples.
+    Calculates the mean and standard deviation of a given array of samples.
+    If the array has more than one dimension, the statistics are calculated
+    for each row.
 
-    @param samples      List of samples
+    @param samples      Array of samples
     @param samplevar    Flag indicating whether samples represent full
                         population or set of samples (defaults to set of
                         samples)
 
     @return     tuple(mean, standard deviation)
     '''
-    mean = sum(samples) / len(samples)
-    variance = sum([(x - mean) ** 2 for x in samples])
+    samples = np.asarray(samples,dtype=np.float64)
     # how we calculate variance depends on whether this is an
     # entire population or just a set of samples
-    size = len(samples) - 1 if samplevar else len(samples)
-    variance = variance / size
-    sdev = math.sqrt(variance)
-    return (mean,sdev)
+    ddof = 1 if samplevar else 0
+    return (samples.mean(axis=-1),samples.std(axis=-1,ddof=ddof))
 
 
 def process_file(filename,datadir,zthresh,write_out=True):
@@ -214,7 +213,7 @@ def process_file(filename,datadir,zthresh,write_out=True):
     Takes path to summary file as input, determines outliers based on given
     Z-score threshold, finds the most representative data point from the
     given data directory, and returns data structure representing that point,
-    along with a list of the associated samples. Optionally writes new summary
+    along with the associated samples. Optionally writes new summary
     files representing the good points and outliers, respectively.
 
     @param filename     Path to summary file
@@ -225,39 +224,29 @@ def process_file(filename,datadir,zthresh,write_out=True):
     The new summary files will be written to the same directory where the
     given summary file exists.
 
-    @return best_point, best_samples
+    @return best_point, best_samples, header
     '''
     # we use the header line if/when we write out new summary files
-    header,data = read_summary_file(filename)
+    header,fnames,lines,fields = read_summary_file(filename)
     # do these data points represent full populations or sample sets?
-    (depth_mean, depth_sdev) = calculate_stats([x.depth for x in data])
-    (stiff_mean, stiff_sdev) = calculate_stats([x.stiff for x in data])
-    (hard_mean, hard_sdev) = calculate_stats([x.hard for x in data])
+    # the statistics for depth, stiffness, and hardness are all
+    # calculated at once over the rows of a single array
+    means, sdevs = calculate_stats(fields)
 
     # weed out the outliers
-    valid_points = list()
-    outliers = list()
-    for x in data:
-        # NOTE: The statistics for this might not be exactly right. 
-        # I'm trying to do a Z-test here, but according to Wikipedia,
-        # to properly do a Z test it is necessary to have a population
-        # mean and standard deviation, and it seems like we only have
-        # a sample mean and standard deviation. I really don't know
-        # enough to say how badly this fudges the stats though.
-        depth_score = (x.depth - depth_mean) / depth_sdev
-        stiff_score = (x.stiff - stiff_mean) / stiff_sdev
-        hard_score = (x.hard - hard_mean) / hard_sdev
-        # reject data points if any of these scores exceeds the threshold
-        if abs(depth_score) >= zthresh:
-            outliers.append(x)
-            continue
-        if abs(stiff_score) >= zthresh:
-            outliers.append(x)
-            continue
-        if abs(hard_score) >= zthresh:
-            outliers.append(x)
-            continue
-        valid_points.append(x)
+    # NOTE: The statistics for this might not be exactly right. 
+    # I'm trying to do a Z-test here, but according to Wikipedia,
+    # to properly do a Z test it is necessary to have a population
+    # mean and standard deviation, and it seems like we only have
+    # a sample mean and standard deviation. I really don't know
+    # enough to say how badly this fudges the stats though.
+    # reject data points if any of these scores exceeds the threshold.
+    # Every field gets the same branch-free test, accumulated in place.
+    outliers = np.zeros(len(lines),dtype=bool)
+    for x,mean,sdev in zip(fields,means,sdevs):
+        score = np.abs((x - mean) / sdev)
+        outliers |= score >= zthresh
+    valid = ~outliers
 
     if write_out:
         # use the same output directory as where the summary file lives
@@ -267,45 +256,45 @@ def process_file(filename,datadir,zthresh,write_out=True):
         # write the processed (clean) summary file
         clean_name = "{}/{}_clean.txt".format(outdir,data_name)
         print("writing processed data to {}".format(clean_name))
-        write_summary_file(clean_name,valid_points,header)
+        write_summary_file(clean_name,lines[valid],header)
         # write the outlier summary file (is this necessary?)
         outlier_name = "{}/{}_outliers.txt".format(outdir,data_name)
         print("writing outliers to {}".format(outlier_name))
-        write_summary_file(outlier_name,outliers,header)
+        write_summary_file(outlier_name,lines[outliers],header)
 
     # find the most representative point
-    best_score = float('inf')
-    best_point = None
-    best_samples = list()
-    for p in valid_points:
-        # NOTE: This is an extremely naive way to compute a similarity
-        # score. Once a better way has been determined, this will need
-        # to be updated.
-        score = abs(p.stiff - stiff_mean)
-        if score < best_score:
-            best_score = score
-            best_point = p
+    stiff, stiff_mean = fields[1], means[1]
+    candidates = np.flatnonzero(valid)
+    if len(candidates) == 0:
+        exitmsg("no valid data points in '{}'".format(filename))
+    # NOTE: This is an extremely naive way to compute a similarity
+    # score. Once a better way has been determined, this will need
+    # to be updated.
+    scores = np.abs(stiff[candidates] - stiff_mean)
+    best = candidates[np.argmin(scores)]
+    best_point = DataLine(fnames[best],*fields[:,best],lines[best])
     datapath = "{}/{}".format(datadir,best_point.fname)
     samples = read_datapoint_file(datapath)
     return best_point, samples, header
 
 
-def add_to_multigraph(point,samples):
+def add_to_multigraph(ax,point,samples):
     '''
     Add the given point to the multi-point plot. Plots the given samples with
     depth vs load.
 
+    @param ax       Axes of the multi-point plot
     @param point    DataLine object representing the given point
-    @param samples  List of DataSamples representing the data to be plotted
+    @param samples  (depth,load,time) arrays representing the data to be
+                    plotted
 
     This routine will not actually show the graph: that is the responsibility
     of the calling routine.
     '''
-    d = [x.depth for x in samples]
-    l = [x.load for x in samples]
-    plt.plot(d,l,label=point.fname)
-    plt.ylabel('Load ($\mu$N)')
-    plt.xlabel('Depth (nm)')
+    d, l, _ = samples
+    ax.plot(d,l,label=point.fname)
+    ax.set_ylabel(r'Load ($\mu$N)')
+    ax.set_xlabel('Depth (nm)')
 
 
 def create_stiff_table(points):
@@ -321,33 +310,32 @@ def create_stiff_table(points):
     '''
 
 
-def graph_one(point,samples):
+def graph_one(fig,point,samples):
     '''
     Graphs a plot representing data from a single point. One subgraph
     represents load vs depth, and the other represents load vs time
     and depth vs time.
 
+    @param fig      Figure to draw the plot on
     @param point    DataLine object representing a single point
-    @param samples  List of DataSample objects representing data associated
+    @param samples  (depth,load,time) arrays representing data associated
                     with this point
 
     This routine will not actually show the graph: that is the responsibility
     of the calling routine.
     '''
-    t = [x.time for x in samples]
-    d = [x.depth for x in samples]
-    l = [x.load for x in samples]
-    fdplot = plt.subplot(211)
-    plt.title('Best Point: {}'.format(point.fname))
-    plt.plot(d,l, color='#170323') # force vs displacement
-    plt.ylabel('Load ($\mu$N)')
-    plt.xlabel('Depth (nm)')
-
-    rateplot1 = plt.subplot(212)#, sharex=dplot)
+    d, l, t = samples
+    fdplot = fig.add_subplot(211)
+    fdplot.set_title('Best Point: {}'.format(point.fname))
+    fdplot.plot(d,l, color='#170323') # force vs displacement
+    fdplot.set_ylabel(r'Load ($\mu$N)')
+    fdplot.set_xlabel('Depth (nm)')
+
+    rateplot1 = fig.add_subplot(212)#, sharex=dplot)
     rateplot2 = rateplot1.twinx()
     rateplot1.plot(t,l) # load against time
     rateplot2.plot(t,d, color='#740001') # displacement vs time
-    rateplot1.set_ylabel('Load ($\mu$N)')
+    rateplot1.set_ylabel(r'Load ($\mu$N)')
     rateplot2.set_ylabel('Depth (nm)', color='#740001')
     rateplot1.set_xlabel('Time (s)')
 
@@ -362,11 +350,9 @@ def read_list_file(filename):
     '''
     if not os.path.exists(filename):
         exitmsg("given list file '{}' does not exist".format(filename))
-    files = list()
     with open(filename) as f:
-        for line in f:
-            if line == '' or line == '\n': continue
-            files.append(line.strip())
+        # skip the empty lines
+        files = [line for line in (l.strip() for l in f) if line]
     return files
 
 
@@ -382,6 +368,8 @@ def main():
             help='p-value threshold for outlier data points')
     p.add_argument('-s','--sdev',action='store',dest='sdev',type=float,
             help='standard deviation threshold for outlier data points')
+    p.add_argument('-b','--batch',action='store_true',dest='batch',
+            help='save the graph to a file instead of displaying it')
     args = p.parse_args()
     if args.pval and args.sdev:
         exitmsg("--pval and --sdev are not compatible")
@@ -396,7 +384,9 @@ def main():
             exitmsg("invalid p value: {}".format(args.pval))
         # we're doing a two-tailed test here
         tails = 1 - args.pval
-        zthresh = stats.norm.ppf(args.pval + tails/2)
+        # scipy is slow to import, so only do it when it's actually needed
+        from scipy.stats import norm
+        zthresh = norm.ppf(args.pval + tails/2)
         print("zthresh={}".format(zthresh))
     else:
         zthresh = DEFAULT_Z_THRESH
@@ -411,34 +401,60 @@ def main():
         outsum = "."
     else:
         summary_files = read_list_file(args.filelist)
-        outsum = os.path.dirname(args.filelist)
+        outsum = os.path.dirname(args.filelist) or "."
 
     num_files = len(summary_files)
-    points, samples = list(), list()
-    for i,f in enumerate(summary_files):
-        print("processing summary file {:3d} of {}: {}" \
-                .format(i+1,num_files,os.path.basename(f)))
+    if num_files == 0:
+        exitmsg("no summary files given")
+    datadirs = list()
+    for f in summary_files:
         datadir = os.path.dirname(os.path.abspath(f))
         if args.data_suffix:
             datadir = "{}/{}".format(datadir,args.data_suffix)
-        p, s, header = process_file(f,datadir,zthresh)
-        points.append(p)
-        samples.append(s)
+        datadirs.append(datadir)
 
+    points, samples = list(), list()
+    # each summary file is independent of the others, so process them in
+    # parallel when there is more than one. Results come back in order.
+    workers = min(num_files,os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        mapper = executor.map if num_files > 1 else map
+        results = mapper(process_file,summary_files,datadirs,repeat(zthresh))
+        for i,(f,(p,s,header)) in enumerate(zip(summary_files,results)):
+            print("processed summary file {:3d} of {}: {}" \
+                    .format(i+1,num_files,os.path.basename(f)))
+            points.append(p)
+            samples.append(s)
+
+    # in batch mode there's no need to start up a GUI backend at all.
+    # pyplot is only imported here, once the backend has been chosen, so
+    # that the worker processes never have to import it.
+    if args.batch:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib import style
     style.use('bmh')
+    fig = plt.figure()
     if num_files == 1:
         print("graphing most representative data file")
-        graph_one(points[0],samples[0])
+        graph_one(fig,points[0],samples[0])
+        graphfile = "{}/{}".format(outsum,"best_point.png")
     else:
-        plt.title('Best Points')
+        ax = fig.add_subplot(111)
+        ax.set_title('Best Points')
         for p,s in zip(points,samples):
-            add_to_multigraph(p,s)
-        plt.legend(loc='upper left')
+            add_to_multigraph(ax,p,s)
+        ax.legend(loc='upper left')
         outfile = "{}/{}".format(outsum,"quasi_compilation.csv")
-        write_summary_file(outfile,points,header)
+        write_summary_file(outfile,[p.line for p in points],header)
         # this currently does nothing
         create_stiff_table(points)
+        graphfile = "{}/{}".format(outsum,"best_points.png")
 
+    if args.batch:
+        print("saving graph to {}".format(graphfile))
+        fig.savefig(graphfile,dpi=100)
+        return
     try:
         plt.show()
     # cleaner handling of keyboard interrupt while plotting